@@ -48,6 +48,9 @@ AVB_FOOTER_VERSION_MINOR = 0
 
 AVB_VBMETA_IMAGE_FLAGS_HASHTREE_DISABLED = 1
 
+# Number of bytes to read at a time when hashing entire images.
+HASH_READ_CHUNK_SIZE = 1024 * 1024
+
 # Configuration for enabling logging of calls to avbtool.
 AVB_INVOCATION_LOGFILE = os.environ.get('AVB_INVOCATION_LOGFILE')
 
@@ -555,10 +558,6 @@ def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
   Returns:
     True if the signature is valid and corresponds to the embedded
     public key. Also returns True if the vbmeta blob is not signed.
-
-  Raises:
-    AvbError: If there errors calling out to openssl command during
-        signature verification.
   """
   (_, alg) = lookup_algorithm_by_type(vbmeta_header.algorithm_type)
   if not alg.hash_name:
@@ -610,50 +609,35 @@ def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
   #  return True
   #
   # but since 'avbtool verify_image' is used on the builders we don't want
-  # to rely on Crypto.PublicKey.RSA. Instead just use openssl(1) to verify.
-  asn1_str = ('asn1=SEQUENCE:pubkeyinfo\n'
-              '\n'
-              '[pubkeyinfo]\n'
-              'algorithm=SEQUENCE:rsa_alg\n'
-              'pubkey=BITWRAP,SEQUENCE:rsapubkey\n'
-              '\n'
-              '[rsa_alg]\n'
-              'algorithm=OID:rsaEncryption\n'
-              'parameter=NULL\n'
-              '\n'
-              '[rsapubkey]\n'
-              'n=INTEGER:{}\n'
-              'e=INTEGER:{}\n').format(hex(modulus).rstrip('L'),
-                                       hex(exponent).rstrip('L'))
-
-  with tempfile.NamedTemporaryFile() as asn1_tmpfile:
-    asn1_tmpfile.write(asn1_str.encode('ascii'))
-    asn1_tmpfile.flush()
-
-    with tempfile.NamedTemporaryFile() as der_tmpfile:
-      p = subprocess.Popen(
-          ['openssl', 'asn1parse', '-genconf', asn1_tmpfile.name, '-out',
-           der_tmpfile.name, '-noout'])
-      retcode = p.wait()
-      if retcode != 0:
-        raise AvbError('Error generating DER file')
-
-      p = subprocess.Popen(
-          ['openssl', 'rsautl', '-verify', '-pubin', '-inkey', der_tmpfile.name,
-           '-keyform', 'DER', '-raw'],
-          stdin=subprocess.PIPE,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE)
-      (pout, perr) = p.communicate(sig_blob)
-      retcode = p.wait()
-      if retcode != 0:
-        raise AvbError('Error verifying data: {}'.format(perr))
-      if pout != padding_and_digest:
-        sys.stderr.write('Signature not correct\n')
-        return False
+  # to rely on Crypto.PublicKey.RSA. Raw RSA verification is just a modular
+  # exponentiation, so do it in-process instead of writing the key to
+  # temporary files and invoking openssl(1) twice for every vbmeta struct.
+  signature = decode_long(sig_blob)
+  if (len(sig_blob) != num_bits // 8 or signature >= modulus or
+      encode_long(num_bits, pow(signature, exponent, modulus)) !=
+      padding_and_digest):
+    sys.stderr.write('Signature not correct\n')
+    return False
   return True
 
 
+def hash_image_data(hasher, image, size):
+  """Feeds data from an image to a hasher without reading it all at once.
+
+  Arguments:
+    hasher: The hashlib object to update.
+    image: An ImageHandler positioned at the data to hash.
+    size: Number of bytes to hash. Fewer bytes are hashed if the end of
+        the image is encountered first.
+  """
+  while size > 0:
+    data = image.read(min(size, HASH_READ_CHUNK_SIZE))
+    if not data:
+      break
+    hasher.update(data)
+    size -= len(data)
+
+
 def create_avb_hashtree_hasher(algorithm, salt):
   """Create the hasher for AVB hashtree based on the input algorithm."""
 
@@ -1192,7 +1176,7 @@ class AvbDescriptor(object):
 
     if data:
       (self.tag, num_bytes_following) = (
-          struct.unpack(self.FORMAT_STRING, data[0:self.SIZE]))
+          struct.unpack_from(self.FORMAT_STRING, data))
       self.data = data[self.SIZE:self.SIZE + num_bytes_following]
     else:
       self.tag = None
@@ -1222,8 +1206,7 @@ class AvbDescriptor(object):
     nbf_with_padding = round_to_multiple(num_bytes_following, 8)
     padding_size = nbf_with_padding - num_bytes_following
     desc = struct.pack(self.FORMAT_STRING, self.tag, nbf_with_padding)
-    padding = struct.pack(str(padding_size) + 'x')
-    ret = desc + self.data + padding
+    ret = desc + self.data + padding_size * b'\0'
     return bytearray(ret)
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
@@ -1280,7 +1263,7 @@ class AvbPropertyDescriptor(AvbDescriptor):
 
     if data:
       (tag, num_bytes_following, key_size,
-       value_size) = struct.unpack(self.FORMAT_STRING, data[0:self.SIZE])
+       value_size) = struct.unpack_from(self.FORMAT_STRING, data)
       expected_size = round_to_multiple(
           self.SIZE - 16 + key_size + 1 + value_size + 1, 8)
       if tag != self.TAG or num_bytes_following != expected_size:
@@ -1414,8 +1397,8 @@ class AvbHashtreeDescriptor(AvbDescriptor):
        self.tree_offset, self.tree_size, self.data_block_size,
        self.hash_block_size, self.fec_num_roots, self.fec_offset, self.fec_size,
        self.hash_algorithm, partition_name_len, salt_len,
-       root_digest_len, self.flags, _) = struct.unpack(self.FORMAT_STRING,
-                                                       data[0:self.SIZE])
+       root_digest_len, self.flags, _) = struct.unpack_from(
+           self.FORMAT_STRING, data)
       expected_size = round_to_multiple(
           self.SIZE - 16 + partition_name_len + salt_len + root_digest_len, 8)
       if tag != self.TAG or num_bytes_following != expected_size:
@@ -1608,8 +1591,8 @@ class AvbHashDescriptor(AvbDescriptor):
     if data:
       (tag, num_bytes_following, self.image_size, self.hash_algorithm,
        partition_name_len, salt_len,
-       digest_len, self.flags, _) = struct.unpack(self.FORMAT_STRING,
-                                                  data[0:self.SIZE])
+       digest_len, self.flags, _) = struct.unpack_from(
+           self.FORMAT_STRING, data)
       expected_size = round_to_multiple(
           self.SIZE - 16 + partition_name_len + salt_len + digest_len, 8)
       if tag != self.TAG or num_bytes_following != expected_size:
@@ -1696,10 +1679,9 @@ class AvbHashDescriptor(AvbDescriptor):
     else:
       image_filename = os.path.join(image_dir, self.partition_name + image_ext)
       image = ImageHandler(image_filename, read_only=True)
-    data = image.read(self.image_size)
     ha = hashlib.new(self.hash_algorithm)
     ha.update(self.salt)
-    ha.update(data)
+    hash_image_data(ha, image, self.image_size)
     digest = ha.digest()
     # The digest must match unless there is no digest in the descriptor.
     if self.digest and digest != self.digest:
@@ -1745,7 +1727,7 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
 
     if data:
       (tag, num_bytes_following, self.flags, kernel_cmdline_length) = (
-          struct.unpack(self.FORMAT_STRING, data[0:self.SIZE]))
+          struct.unpack_from(self.FORMAT_STRING, data))
       expected_size = round_to_multiple(self.SIZE - 16 + kernel_cmdline_length,
                                         8)
       if tag != self.TAG or num_bytes_following != expected_size:
@@ -1844,8 +1826,8 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
     if data:
       (tag, num_bytes_following, self.rollback_index_location,
        partition_name_len,
-       public_key_len, self.flags, _) = struct.unpack(self.FORMAT_STRING,
-                                                      data[0:self.SIZE])
+       public_key_len, self.flags, _) = struct.unpack_from(
+           self.FORMAT_STRING, data)
       expected_size = round_to_multiple(
           self.SIZE - 16 + partition_name_len + public_key_len, 8)
       if tag != self.TAG or num_bytes_following != expected_size:
@@ -1964,7 +1946,7 @@ def parse_descriptors(data):
   o = 0
   ret = []
   while o < len(data):
-    tag, nb_following = struct.unpack('!2Q', data[o:o + 16])
+    tag, nb_following = struct.unpack_from('!2Q', data, o)
     if tag < len(DESCRIPTOR_CLASSES):
       clazz = DESCRIPTOR_CLASSES[tag]
     else:
@@ -2217,10 +2199,8 @@ class Avb(object):
           generation.
     """
     pattern = bytearray([x & 0xFF for x in range(start_byte, start_byte + 256)])
-    buf = bytearray()
     c = int(math.ceil(image_size / 256.0))
-    for _ in range(0, c):
-      buf.extend(pattern)
+    buf = pattern * c
     output.write(buf[0:image_size])
 
   def extract_vbmeta_image(self, output, image_filename, padding_size):
@@ -2435,8 +2415,16 @@ class Avb(object):
     o = output
     (footer, header, descriptors, image_size) = self._parse_image(image)
 
-    # To show the SHA1 of the public key.
-    vbmeta_blob = self._load_vbmeta_blob(image)
+    # To show the SHA1 of the public key. The footer and header have
+    # already been parsed so read the vbmeta struct directly instead of
+    # going through _load_vbmeta_blob() which would parse them again.
+    offset = 0
+    if footer:
+      offset = footer.vbmeta_offset
+    image.seek(offset)
+    vbmeta_blob = image.read(header.SIZE
+                             + header.authentication_data_block_size
+                             + header.auxiliary_data_block_size)
     key_offset = (header.SIZE +
                   header.authentication_data_block_size +
                   header.public_key_offset)
@@ -3193,7 +3181,8 @@ class Avb(object):
       if not key_path:
         raise AvbError('Key is required for algorithm {}'.format(
             algorithm_name))
-      encoded_key = RSAPublicKey(key_path).encode()
+      key = RSAPublicKey(key_path)
+      encoded_key = key.encode()
       if len(encoded_key) != alg.public_key_num_bytes:
         raise AvbError('Key is wrong size for algorithm {}'.format(
             algorithm_name))
@@ -3253,11 +3242,10 @@ class Avb(object):
       ha.update(aux_data_blob)
       binary_hash = ha.digest()
 
-      # Calculate the signature.
-      rsa_key = RSAPublicKey(key_path)
-      data_to_sign = header_data_blob + bytes(aux_data_blob)
-      binary_signature = rsa_key.sign(algorithm_name, data_to_sign,
-                                      signing_helper, signing_helper_with_files)
+      # Calculate the signature, reusing the key loaded above.
+      data_to_sign = b''.join((header_data_blob, aux_data_blob))
+      binary_signature = key.sign(algorithm_name, data_to_sign,
+                                  signing_helper, signing_helper_with_files)
 
     # Generate Authentication data block.
     auth_data_blob = bytearray()
@@ -3266,7 +3254,7 @@ class Avb(object):
     padding_bytes = h.authentication_data_block_size - len(auth_data_blob)
     auth_data_blob.extend(b'\0' * padding_bytes)
 
-    return header_data_blob + bytes(auth_data_blob) + bytes(aux_data_blob)
+    return b''.join((header_data_blob, auth_data_blob, aux_data_blob))
 
   def extract_public_key(self, key_path, output):
     """Implements the 'extract_public_key' command.
@@ -3507,11 +3495,8 @@ class Avb(object):
         salt = b''
 
       hasher = hashlib.new(hash_algorithm, salt)
-      # TODO(zeuthen): might want to read this in chunks to avoid
-      # memory pressure, then again, this is only supposed to be used
-      # on kernel/initramfs partitions. Possible optimization.
       image.seek(0)
-      hasher.update(image.read(image.image_size))
+      hash_image_data(hasher, image, image.image_size)
       digest = hasher.digest()
 
       h_desc = AvbHashDescriptor()
@@ -4146,13 +4131,18 @@ def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
     second element is the hash-tree as bytes.
   """
   hash_ret = bytearray(tree_size)
+  hash_ret_view = memoryview(hash_ret)
   hash_src_offset = 0
   hash_src_size = image_size
   level_num = 0
 
+  # Every block is hashed with the same salt prefix, so absorb it once and
+  # start each block from a copy of that state.
+  salted_hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
+
   # If there is only one block, returns the top-level hash directly.
   if hash_src_size == block_size:
-    hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
+    hasher = salted_hasher.copy()
     image.seek(0)
     hasher.update(image.read(block_size))
     return hasher.digest(), bytes(hash_ret)
@@ -4161,15 +4151,16 @@ def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
     level_output_list = []
     remaining = hash_src_size
     while remaining > 0:
-      hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
+      hasher = salted_hasher.copy()
       # Only read from the file for the first level - for subsequent
-      # levels, access the array we're building.
+      # levels, access the array we're building (through a memoryview, so
+      # hash blocks aren't copied).
       if level_num == 0:
         image.seek(hash_src_offset + hash_src_size - remaining)
         data = image.read(min(remaining, block_size))
       else:
         offset = hash_level_offsets[level_num - 1] + hash_src_size - remaining
-        data = hash_ret[offset:offset + block_size]
+        data = hash_ret_view[offset:offset + block_size]
       hasher.update(data)
 
       remaining -= len(data)
@@ -4193,7 +4184,7 @@ def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
     hash_src_size = len(level_output)
     level_num += 1
 
-  hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
+  hasher = salted_hasher.copy()
   hasher.update(level_output)
   return hasher.digest(), bytes(hash_ret)
 